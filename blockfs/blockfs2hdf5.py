@@ -2,7 +2,9 @@ import argparse
 import itertools
 from mpi4py import MPI
 import h5py
-from .directory import Directory
+import numpy as np
+import os
+from .directory import Directory, set_blosc_threads
 import sys
 import logging
 import tqdm
@@ -34,15 +36,65 @@ def parse_args(args=sys.argv[1:]):
     parser.add_argument(
         "--compression-opts",
         help="Compression options: see h5py documentation for options")
+    parser.add_argument(
+        "--memory",
+        help="The maximum size, in GB, of the buffer each rank uses to "
+        "assemble the part of a z-slab that it writes at one time.",
+        default=4,
+        type=float)
     return parser.parse_args(args)
 
 
+def open_hdf5(path):
+    """
+    Open or create an HDF5 file for parallel writing
+
+    Metadata reads and writes are done collectively so that they are
+    performed once and broadcast, rather than by every rank.
+
+    :param path: the path to the HDF5 file
+    :return: an h5py File
+    """
+    info = MPI.Info.Create()
+    info.Set("romio_cb_write", "enable")
+    info.Set("romio_ds_write", "disable")
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_fapl_mpio(comm, info)
+    fapl.set_all_coll_metadata_ops(True)
+    fapl.set_coll_metadata_write(True)
+    if os.path.exists(path):
+        fid = h5py.h5f.open(os.fsencode(path), h5py.h5f.ACC_RDWR, fapl=fapl)
+    else:
+        fid = h5py.h5f.create(os.fsencode(path), h5py.h5f.ACC_EXCL,
+                              fapl=fapl)
+    return h5py.File(fid)
+
+
+def write_nothing(ds):
+    """
+    Take part in a collective write to a dataset without writing anything
+
+    :param ds: the h5py dataset being written collectively
+    """
+    fspace = ds.id.get_space()
+    fspace.select_none()
+    mspace = h5py.h5s.create_simple((1,))
+    mspace.select_none()
+    dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+    dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+    ds.id.write(mspace, fspace, np.zeros(1, ds.dtype), dxpl=dxpl)
+
+
 def main(args=sys.argv[1:]):
     opts = parse_args(args)
+    # Divide this node's cores among the ranks running on it
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    set_blosc_threads(node_comm.size)
+    node_comm.Free()
     directory = Directory.open(opts.src)
     block_size = directory.get_block_size(0, 0, 0)
     logging.info("Opened %s" % opts.src)
-    f = h5py.File(opts.dest, "a", driver="mpio", comm=comm)
+    f = open_hdf5(opts.dest)
     logging.info("Opened %s" % opts.dest)
     cd_args = dict(shape=directory.shape,
                    chunks=block_size,
@@ -53,20 +105,41 @@ def main(args=sys.argv[1:]):
     ds = f.create_dataset(opts.name, **cd_args)
     logging.info("Created dataset %s" % opts.name)
     zs, ys, xs = directory.get_block_size(0, 0, 0)
-    if rank == 0:
-        work = list(itertools.product(range(0, directory.shape[2], xs),
-                                      range(0, directory.shape[1], ys),
-                                      range(0, directory.shape[0], zs)))
-        work = [work[i::size] for i in range(size)]
-    else:
-        work = None
-    work = comm.scatter(work, root=0)
-    for x0, y0, z0 in tqdm.tqdm(work, disable=rank > 0):
-        block = directory.read_block(x0, y0, z0)
-        with ds.collective:
-            ds[z0:z0+block.shape[0],
-            y0:y0+block.shape[1],
-            x0:x0+block.shape[2]] = block
+    z_extent, y_extent, x_extent = directory.shape
+    slabs = range(0, z_extent, zs)
+    #
+    # Each rank assembles whole z-slabs and writes them with large
+    # hyperslabs. Slabs are dealt out round-robin, so each rank can find
+    # its own share without any communication. Every rank takes part in
+    # every round's collective writes - parallel HDF5 only allows
+    # collective writes to filtered datasets - and a rank with no slab
+    # left in a round joins with an empty selection.
+    #
+    work = slabs[rank::size]
+    n_rounds = (len(slabs) + size - 1) // size
+    #
+    # Bound the buffer by writing each slab in pieces of whole block rows
+    #
+    row_nbytes = zs * x_extent * directory.dtype.itemsize
+    y_step = int(opts.memory * 1000 * 1000 * 1000) // row_nbytes // ys * ys
+    y_step = min(max(ys, y_step), y_extent)
+    buf = np.zeros((zs, y_step, x_extent), directory.dtype)
+    for idx in tqdm.tqdm(range(n_rounds), disable=rank > 0):
+        for y_start in range(0, y_extent, y_step):
+            y_end = min(y_start + y_step, y_extent)
+            if idx >= len(work):
+                write_nothing(ds)
+                continue
+            z0 = work[idx]
+            z1 = min(z0 + zs, z_extent)
+            for y0, x0 in itertools.product(range(y_start, y_end, ys),
+                                            range(0, x_extent, xs)):
+                block = directory.read_block(x0, y0, z0)
+                buf[:z1 - z0,
+                    y0 - y_start:y0 - y_start + block.shape[1],
+                    x0:x0 + block.shape[2]] = block
+            with ds.collective:
+                ds[z0:z1, y_start:y_end] = buf[:z1 - z0, :y_end - y_start]
     comm.Barrier()
     f.close()
 
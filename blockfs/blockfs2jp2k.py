@@ -8,8 +8,11 @@ from mp_shared_memory import SharedMemory
 import multiprocessing
 import sys
 import glymur
+import logging
 
-from .directory import Directory
+from .directory import Directory, set_blosc_threads
+
+logger = logging.getLogger()
 
 
 def parse_args(args=sys.argv[1:]):
@@ -39,6 +42,13 @@ def parse_args(args=sys.argv[1:]):
         default=0,
         type=float
     )
+    parser.add_argument(
+        "--encoder-threads",
+        help="The number of threads OpenJPEG uses to encode each plane. "
+        "The default is to spread the worker processes' share of cores "
+        "over the planes that are encoded at one time.",
+        type=int
+    )
     parser.add_argument(
         "--memory",
         help="Maximum amount of memory to use in GB",
@@ -49,16 +59,32 @@ def parse_args(args=sys.argv[1:]):
 
 
 DIRECTORY = None
+SHMS = None
+# Number of block reads handed to a worker at a time
+READ_CHUNKSIZE = 8
+# One buffer is read into while the planes of the other are written
+N_BUFFERS = 2
 
 
-def read_block(shm, xoff, yoff, zoff, x0, x1, y0, y1, z0, z1):
-    with shm.txn() as m:
-        m[z0-zoff:z1-zoff, y0-yoff:y1-yoff, x0-xoff:x1-xoff] = \
-            DIRECTORY.read_block(x0, y0, z0)
+def init_worker(shms, n_workers, encoder_threads):
+    global SHMS
+    SHMS = shms
+    set_blosc_threads(n_workers)
+    if encoder_threads > 1:
+        glymur.set_option("lib.num_threads", encoder_threads)
 
 
-def write_plane(shm, path, z, psnr):
-    with shm.txn() as m:
+def read_block(args):
+    buf_idx, xoff, yoff, zoff, x0, x1, y0, y1, z0, z1 = args
+    with SHMS[buf_idx].txn() as m:
+        DIRECTORY.read_block_into(
+            x0, y0, z0,
+            out=m[z0-zoff:z1-zoff, y0-yoff:y1-yoff, x0-xoff:x1-xoff])
+
+
+def write_plane(args):
+    buf_idx, path, z, psnr = args
+    with SHMS[buf_idx].txn() as m:
         glymur.Jp2k(path, data=m[z], psnr=[psnr])
 
 
@@ -67,44 +93,95 @@ def main(args=sys.argv[1:]):
     opts = parse_args(args)
     DIRECTORY = Directory.open(opts.input)
     mem_z_block_size = opts.memory * 1000 * 1000 * 1000 // \
-        DIRECTORY.y_extent // DIRECTORY.x_extent // 2
-    z_block_size = min(DIRECTORY.z_block_size, mem_z_block_size)
-    shm = SharedMemory(
+        DIRECTORY.y_extent // DIRECTORY.x_extent // 2 // N_BUFFERS
+    #
+    # Blocks are read whole, so a slab must be a whole number of blocks deep
+    #
+    if mem_z_block_size < DIRECTORY.z_block_size:
+        sys.exit("--memory %d GB is too small: %d buffers of one block "
+                 "depth (%d planes) are needed" %
+                 (opts.memory, N_BUFFERS, DIRECTORY.z_block_size))
+    z_block_size = DIRECTORY.z_block_size
+    shms = [SharedMemory(
         (z_block_size, DIRECTORY.y_extent, DIRECTORY.x_extent),
-        DIRECTORY.dtype
-    )
+        DIRECTORY.dtype) for _ in range(N_BUFFERS)]
+    if opts.encoder_threads is None:
+        encoder_threads = max(1, opts.n_workers // z_block_size)
+    else:
+        encoder_threads = opts.encoder_threads
+    if encoder_threads > 1:
+        #
+        # Older glymur doesn't know the option and OpenJPEG < 2.4 can't
+        # use threads. Find out here: an exception in the pool initializer
+        # would make the pool respawn its workers forever.
+        #
+        try:
+            glymur.set_option("lib.num_threads", encoder_threads)
+        except (KeyError, RuntimeError):
+            logger.warning("OpenJPEG threads are not available, "
+                           "encoding each plane with one thread")
+            encoder_threads = 1
     dirnames = set()
-    for z0 in range(0, DIRECTORY.z_extent, z_block_size):
-        with multiprocessing.Pool(opts.n_workers) as pool:
-            z1 = min(z0 + z_block_size, DIRECTORY.z_extent)
-            yr = range(0, DIRECTORY.y_extent, DIRECTORY.y_block_size)
-            xr = range(0, DIRECTORY.x_extent, DIRECTORY.x_block_size)
-            futures = []
-            for x0, y0 in itertools.product(xr, yr):
-                x1 = min(x0 + DIRECTORY.x_block_size, DIRECTORY.x_extent)
-                y1 = min(y0 + DIRECTORY.y_block_size, DIRECTORY.y_extent)
-                futures.append(pool.apply_async(
-                    read_block,
-                    (shm, 0, 0, z0, x0, x1, y0, y1, z0, z1)))
-            for future in tqdm.tqdm(futures,
-                desc="Reading %d:%d" % (z0, z1),
-                disable=opts.silent):
-                future.get()
-            futures = []
-            for z in range(z0, z1):
-                path = opts.output_pattern % z
-                dirname = os.path.dirname(path)
-                if dirname not in dirnames:
-                    if not os.path.exists(dirname):
-                        os.makedirs(dirname)
-                    dirnames.add(dirname)
-                futures.append(pool.apply_async(
-                    write_plane, (shm, path, z - z0, opts.psnr)))
-            for future in tqdm.tqdm(
-                futures,
-                desc="Writing %d:%d" % (z0, z1),
-                disable=opts.silent):
-                future.get()
+
+    def read_tasks(buf_idx, z0, z1):
+        yr = range(0, DIRECTORY.y_extent, DIRECTORY.y_block_size)
+        xr = range(0, DIRECTORY.x_extent, DIRECTORY.x_block_size)
+        tasks = []
+        for x0, y0 in itertools.product(xr, yr):
+            x1 = min(x0 + DIRECTORY.x_block_size, DIRECTORY.x_extent)
+            y1 = min(y0 + DIRECTORY.y_block_size, DIRECTORY.y_extent)
+            tasks.append((buf_idx, 0, 0, z0, x0, x1, y0, y1, z0, z1))
+        return tasks
+
+    def write_tasks(buf_idx, z0, z1):
+        tasks = []
+        for z in range(z0, z1):
+            path = opts.output_pattern % z
+            dirname = os.path.dirname(path)
+            if dirname not in dirnames:
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                dirnames.add(dirname)
+            tasks.append((buf_idx, path, z - z0, opts.psnr))
+        return tasks
+
+    def wait(results, n_tasks, desc):
+        for _ in tqdm.tqdm(results, total=n_tasks, desc=desc,
+                           disable=opts.silent):
+            pass
+
+    z0s = list(range(0, DIRECTORY.z_extent, z_block_size))
+
+    def slab(idx):
+        return z0s[idx], min(z0s[idx] + z_block_size, DIRECTORY.z_extent)
+
+    with multiprocessing.Pool(opts.n_workers,
+                              initializer=init_worker,
+                              initargs=(shms, opts.n_workers,
+                                        encoder_threads)) as pool:
+        #
+        # The reads for slab idx + 1 are queued before waiting on the
+        # writes for slab idx so that the two overlap. The buffer they
+        # read into was last used by the writes for slab idx - 1, which
+        # have already completed.
+        #
+        tasks = read_tasks(0, *slab(0))
+        reads = pool.imap_unordered(read_block, tasks,
+                                    chunksize=READ_CHUNKSIZE)
+        n_reads = len(tasks)
+        for idx in range(len(z0s)):
+            buf_idx = idx % N_BUFFERS
+            z0, z1 = slab(idx)
+            wait(reads, n_reads, "Reading %d:%d" % (z0, z1))
+            tasks = write_tasks(buf_idx, z0, z1)
+            writes = pool.imap_unordered(write_plane, tasks)
+            n_writes = len(tasks)
+            if idx + 1 < len(z0s):
+                tasks = read_tasks((idx + 1) % N_BUFFERS, *slab(idx + 1))
+                reads = pool.imap_unordered(read_block, tasks,
+                                            chunksize=READ_CHUNKSIZE)
+                n_reads = len(tasks)
+            wait(writes, n_writes, "Writing %d:%d" % (z0, z1))
 
 
 if __name__=="__main__":
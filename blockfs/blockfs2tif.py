@@ -9,7 +9,7 @@ import multiprocessing
 import sys
 import tifffile
 
-from .directory import Directory
+from .directory import Directory, set_blosc_threads
 
 
 def parse_args(args=sys.argv[1:]):
@@ -39,66 +39,133 @@ def parse_args(args=sys.argv[1:]):
         default=3,
         type=int
     )
+    parser.add_argument(
+        "--compression-threads",
+        help="The number of threads used to compress the strips of each "
+        "plane. The default is to spread the worker processes' share of "
+        "cores over the planes that are written at one time.",
+        type=int
+    )
     return parser.parse_args(args)
 
 
 DIRECTORY = None
+SHMS = None
+# Number of block reads handed to a worker at a time
+READ_CHUNKSIZE = 8
+# One buffer is read into while the planes of the other are written
+N_BUFFERS = 2
+# TIFF strips are compressed independently, so they can be done in parallel
+ROWS_PER_STRIP = 64
+COMPRESSION_THREADS = 1
 
 
-def read_block(shm, xoff, yoff, zoff, x0, x1, y0, y1, z0, z1):
-    with shm.txn() as m:
-        m[z0-zoff:z1-zoff, y0-yoff:y1-yoff, x0-xoff:x1-xoff] = \
-            DIRECTORY.read_block(x0, y0, z0)
+def init_worker(shms, n_workers, compression_threads):
+    global SHMS, COMPRESSION_THREADS
+    SHMS = shms
+    COMPRESSION_THREADS = compression_threads
+    set_blosc_threads(n_workers)
 
 
-def write_plane(shm, path, z, compression):
-    with shm.txn() as m:
+def read_block(args):
+    buf_idx, xoff, yoff, zoff, x0, x1, y0, y1, z0, z1 = args
+    with SHMS[buf_idx].txn() as m:
+        DIRECTORY.read_block_into(
+            x0, y0, z0,
+            out=m[z0-zoff:z1-zoff, y0-yoff:y1-yoff, x0-xoff:x1-xoff])
+
+
+def write_plane(args):
+    buf_idx, path, z, compression = args
+    with SHMS[buf_idx].txn() as m:
         # More than 31 bits? Time to use bigtiff
         n_bits= np.log(m.dtype.itemsize * np.prod(m[z].shape)) / np.log(2)
         bigtiff =  n_bits > 31
-        tifffile.imsave(path, m[z], compress=compression, bigtiff=bigtiff)
+        if compression > 0:
+            kwargs = dict(compression="zlib",
+                          compressionargs=dict(level=compression))
+        else:
+            kwargs = {}
+        tifffile.imwrite(path, m[z], bigtiff=bigtiff,
+                         rowsperstrip=ROWS_PER_STRIP,
+                         maxworkers=COMPRESSION_THREADS,
+                         **kwargs)
 
 
 def main(args=sys.argv[1:]):
     global DIRECTORY
     opts = parse_args(args)
     DIRECTORY = Directory.open(opts.input)
-    shm = SharedMemory(
+    shms = [SharedMemory(
         (DIRECTORY.z_block_size, DIRECTORY.y_extent, DIRECTORY.x_extent),
-        DIRECTORY.dtype
-    )
+        DIRECTORY.dtype) for _ in range(N_BUFFERS)]
+    if opts.compression_threads is None:
+        compression_threads = \
+            max(1, opts.n_workers // DIRECTORY.z_block_size)
+    else:
+        compression_threads = opts.compression_threads
     dirnames = set()
-    with multiprocessing.Pool(opts.n_workers) as pool:
-        for z0 in range(0, DIRECTORY.z_extent, DIRECTORY.z_block_size):
-            z1 = min(z0 + DIRECTORY.z_block_size, DIRECTORY.z_extent)
-            yr = range(0, DIRECTORY.y_extent, DIRECTORY.y_block_size)
-            xr = range(0, DIRECTORY.x_extent, DIRECTORY.x_block_size)
-            futures = []
-            for x0, y0 in itertools.product(xr, yr):
-                x1 = min(x0 + DIRECTORY.x_block_size, DIRECTORY.x_extent)
-                y1 = min(y0 + DIRECTORY.y_block_size, DIRECTORY.y_extent)
-                futures.append(pool.apply_async(
-                    read_block,
-                    (shm, 0, 0, z0, x0, x1, y0, y1, z0, z1)))
-            for future in tqdm.tqdm(futures,
-                desc="Reading %d:%d" % (z0, z1),
-                disable=opts.silent):
-                future.get()
-            futures = []
-            for z in range(z0, z1):
-                path = opts.output_pattern % z
-                dirname = os.path.dirname(path)
-                if dirname not in dirnames:
-                    if not os.path.exists(dirname):
-                        os.makedirs(dirname)
-                    dirnames.add(dirname)
-                futures.append(pool.apply_async(
-                    write_plane, (shm, path, z - z0, opts.compression)))
-            for future in tqdm.tqdm(
-                futures,
-                desc="Writing %d:%d" % (z0, z1),
-                disable=opts.silent):
-                future.get()
+
+    def read_tasks(buf_idx, z0, z1):
+        yr = range(0, DIRECTORY.y_extent, DIRECTORY.y_block_size)
+        xr = range(0, DIRECTORY.x_extent, DIRECTORY.x_block_size)
+        tasks = []
+        for x0, y0 in itertools.product(xr, yr):
+            x1 = min(x0 + DIRECTORY.x_block_size, DIRECTORY.x_extent)
+            y1 = min(y0 + DIRECTORY.y_block_size, DIRECTORY.y_extent)
+            tasks.append((buf_idx, 0, 0, z0, x0, x1, y0, y1, z0, z1))
+        return tasks
+
+    def write_tasks(buf_idx, z0, z1):
+        tasks = []
+        for z in range(z0, z1):
+            path = opts.output_pattern % z
+            dirname = os.path.dirname(path)
+            if dirname not in dirnames:
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                dirnames.add(dirname)
+            tasks.append((buf_idx, path, z - z0, opts.compression))
+        return tasks
+
+    def wait(results, n_tasks, desc):
+        for _ in tqdm.tqdm(results, total=n_tasks, desc=desc,
+                           disable=opts.silent):
+            pass
+
+    z0s = list(range(0, DIRECTORY.z_extent, DIRECTORY.z_block_size))
+
+    def slab(idx):
+        return z0s[idx], min(z0s[idx] + DIRECTORY.z_block_size,
+                             DIRECTORY.z_extent)
+
+    with multiprocessing.Pool(opts.n_workers,
+                              initializer=init_worker,
+                              initargs=(shms, opts.n_workers,
+                                        compression_threads)) as pool:
+        #
+        # The reads for slab idx + 1 are queued before waiting on the
+        # writes for slab idx so that the two overlap. The buffer they
+        # read into was last used by the writes for slab idx - 1, which
+        # have already completed.
+        #
+        tasks = read_tasks(0, *slab(0))
+        reads = pool.imap_unordered(read_block, tasks,
+                                    chunksize=READ_CHUNKSIZE)
+        n_reads = len(tasks)
+        for idx in range(len(z0s)):
+            buf_idx = idx % N_BUFFERS
+            z0, z1 = slab(idx)
+            wait(reads, n_reads, "Reading %d:%d" % (z0, z1))
+            tasks = write_tasks(buf_idx, z0, z1)
+            writes = pool.imap_unordered(write_plane, tasks)
+            n_writes = len(tasks)
+            if idx + 1 < len(z0s):
+                tasks = read_tasks((idx + 1) % N_BUFFERS, *slab(idx + 1))
+                reads = pool.imap_unordered(read_block, tasks,
+                                            chunksize=READ_CHUNKSIZE)
+                n_reads = len(tasks)
+            wait(writes, n_writes, "Writing %d:%d" % (z0, z1))
 
 
 if __name__=="__main__":
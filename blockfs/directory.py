@@ -38,17 +38,23 @@ offset = ((x // XBlockSize) * XStride + (y // YBlockSize) * YStride +
 file_index = offset % (len(BlockFilenames))
 directory_entry_offset = DirOffset + offset * (NOffsetBits + NSizeBits) // 8
 filename = BlockFilenames[file_index]
+
+All binary fields - MDSize, DirOffset and the directory entries - are
+little-endian.
 '''
 
 import enum
-import io
+import itertools
 import json
 import logging
+import mmap
 import numpy as np
 import os
+import queue
+import struct
 
 import typing
-from numcodecs import Blosc
+from numcodecs import Blosc, blosc
 import multiprocessing
 import threading
 from .writer import BlockWriter
@@ -56,6 +62,23 @@ import time
 
 logger = logging.getLogger()
 
+
+def set_blosc_threads(n_processes=1):
+    """
+    Set the number of threads Blosc uses in this process
+
+    The cores are divided evenly among n_processes processes. The
+    BLOSC_NTHREADS environment variable, if set, takes precedence.
+
+    :param n_processes: the number of processes sharing the machine's cores
+    """
+    if "BLOSC_NTHREADS" in os.environ:
+        n_threads = int(os.environ["BLOSC_NTHREADS"])
+    else:
+        n_threads = max(1, (os.cpu_count() or 1) // n_processes)
+    blosc.set_nthreads(min(n_threads, blosc.MAX_THREADS))
+
+
 class Compression(enum.Enum):
     """Compression type for Blosc"""
     zstd=1
@@ -70,6 +93,8 @@ class Directory:
 
     HEADER = b"BlockFS\0"
     CURRENT_VERSION = "1.0.0"
+    # Maximum number of directory entries written per batch
+    DIRECTORY_WRITE_BATCH_SIZE = 1024
 
     def __init__(self, x_extent, y_extent, z_extent, dtype,
                  directory_filename,
@@ -149,20 +174,25 @@ class Directory:
         self.directory_entry_size = (n_offset_bits + n_size_bits + 7) // 8
         self.compression = compression
         self.compression_level = compression_level
+        cname = compression.name if isinstance(compression, Compression) \
+            else compression
+        self._codec = Blosc(cname=cname, clevel=compression_level)
         if metadata is None:
             metadata = {}
         self.metadata = metadata
         self.directory_offset = directory_offset
         self.writers = None
         self.directory_writer = None
-        self.file_sizes = {}
-        self.file_handles:typing.Dict[str, io.BufferedReader] = {}
+        self._dir_mmap:typing.Optional[mmap.mmap] = None
+        self._block_fds:typing.Dict[int, int] = {}
+        self._scratch = threading.local()
 
     def __del__(self):
-        for fh in self.file_handles.values():
-            fh.close()
+        self.close_readers()
 
-    def start_writer_processes(self, queue_depth=10):
+    def start_writer_processes(self, queue_depth=10, n_threads=None,
+                               encode_in_producer=False,
+                               use_shared_memory=False):
         """
         Start writer processes. In a multiprocessing scenario, it's useful
         to do this before the fork so that subprocesses can use the queues.
@@ -173,18 +203,37 @@ class Directory:
         :param queue_depth: The maximum number of chunks that can be enqueued
         for any one writer. Max memory enqueued is x_block_size * y_block_size *
         z_block_size * len(block_filenames) * queue_depth * dtype.itemsize
+        :param n_threads: the number of threads each writer process uses to
+        compress a block. There is one writer process per block file, so
+        the total is n_threads * len(block_filenames). If None, numcodecs'
+        default is used.
+        :param encode_in_producer: if True, write_block compresses each block
+        in the calling process and sends only the compressed bytes to the
+        writer process. This pays off when many processes call write_block.
+        :param use_shared_memory: if True, blocks are passed to the writer
+        processes through queue_depth shared memory slots per block file
+        rather than being pickled. This needs room in /dev/shm for
+        queue_depth * len(block_filenames) blocks.
         """
         if self.writers is not None:
             return
+        if use_shared_memory:
+            block_nbytes = self.x_block_size * self.y_block_size * \
+                           self.z_block_size * self.dtype.itemsize
+        else:
+            block_nbytes = None
         self.upqueue = multiprocessing.Queue()
-        down_queues = [multiprocessing.Queue(queue_depth)
+        down_queues = [multiprocessing.JoinableQueue(queue_depth)
                        for _ in self.block_filenames]
         self.writers = [
             BlockWriter(block_filename, self.upqueue,
                         down_queue,
                         self.compression.name,
                         self.compression_level,
-                        queue_depth=queue_depth)
+                        queue_depth=queue_depth,
+                        block_nbytes=block_nbytes,
+                        n_threads=n_threads,
+                        encode_in_producer=encode_in_producer)
             for block_filename, down_queue
             in zip(self.block_filenames,
                    down_queues)]
@@ -196,15 +245,22 @@ class Directory:
             writer.start()
 
     def close(self):
+        self.close_readers()
         if self.writers is None:
             return
+        errors = []
         for writer in self.writers:
-            writer.stop()
+            try:
+                writer.stop()
+            except IOError as e:
+                errors.append(e)
         for writer in self.writers:
             writer.close()
         self.upqueue.put(None)
         self.directory_writer.join()
         self.writers = None
+        if len(errors) > 0:
+            raise errors[0]
 
     def offsetof(self, x, y, z):
         """
@@ -218,6 +274,21 @@ class Directory:
                self.y_stride * (y // self.y_block_size) + \
                self.z_stride * (z // self.z_block_size)
 
+    def offsets_grid(self, xs, ys, zs):
+        """
+        The directory offsets of every block on a grid of block coordinates
+
+        :param xs: the x coordinates of the grid
+        :param ys: the y coordinates of the grid
+        :param zs: the z coordinates of the grid
+        :return: the offsets, in z, y, x order with x varying fastest
+        """
+        ox = (np.asarray(xs) // self.x_block_size) * self.x_stride
+        oy = (np.asarray(ys) // self.y_block_size) * self.y_stride
+        oz = (np.asarray(zs) // self.z_block_size) * self.z_stride
+        return (oz[:, None, None] + oy[None, :, None] + ox[None, None, :])\
+            .ravel()
+
     def encode_directory_entry(self, a, offset, size):
         """
         Encode a directory entry into an array or view
@@ -226,10 +297,13 @@ class Directory:
         :param offset: the offset to encode
         :param size: the size to encode
         """
-        offset_and_size = offset + size * 2 ** self.n_offset_bits
-        for idx in range(self.directory_entry_size):
-            a[idx] = offset_and_size & 0xff
-            offset_and_size = offset_and_size >> 8
+        if self.directory_entry_size <= 8:
+            v = int(offset) | (int(size) << self.n_offset_bits)
+            a[:self.directory_entry_size] = np.frombuffer(
+                struct.pack("<Q", v), np.uint8, self.directory_entry_size)
+            return
+        a[:self.directory_entry_size] = \
+            np.frombuffer(self.encode_entries(offset, size), np.uint8)
 
     def decode_directory_entry(self, a):
         """
@@ -238,15 +312,69 @@ class Directory:
         :param a: an array or view of a directory entry
         :return: a two tuple of offset and size
         """
-        accumulator = 0
-        pow = 1
-        for b in a:
-            accumulator = accumulator + int(b) * pow
-            pow = pow * 256
-        offset = accumulator & ((1 << self.n_offset_bits) - 1)
-        size = (accumulator >> self.n_offset_bits) & \
-               ((1 << self.n_size_bits) - 1)
-        return offset, size
+        if self.directory_entry_size <= 8:
+            v, = struct.unpack(
+                "<Q", bytes(a[:self.directory_entry_size]).ljust(8, b"\0"))
+            return v & ((1 << self.n_offset_bits) - 1), \
+                (v >> self.n_offset_bits) & ((1 << self.n_size_bits) - 1)
+        offsets, sizes = self.decode_entries(a)
+        return int(offsets[0]), int(sizes[0])
+
+    def encode_entries(self, offsets, sizes):
+        """
+        Encode a run of directory entries
+
+        :param offsets: the offsets of the blocks within their block files
+        :param sizes: the sizes of the compressed blocks
+        :return: the encoded entries, end-to-end, as bytes
+        """
+        offsets = np.atleast_1d(np.asarray(offsets, np.uint64))
+        sizes = np.atleast_1d(np.asarray(sizes, np.uint64))
+        if self.directory_entry_size > 8:
+            #
+            # Too wide for a uint64: lay out the bits of each field
+            # side-by-side and pack them back into bytes.
+            #
+            bits = np.zeros((len(offsets), self.directory_entry_size * 8),
+                            np.uint8)
+            bits[:, :self.n_offset_bits] = np.unpackbits(
+                offsets.astype("<u8").view(np.uint8).reshape(-1, 8),
+                axis=1, bitorder="little")[:, :self.n_offset_bits]
+            bits[:, self.n_offset_bits:
+                    self.n_offset_bits + self.n_size_bits] = np.unpackbits(
+                sizes.astype("<u8").view(np.uint8).reshape(-1, 8),
+                axis=1, bitorder="little")[:, :self.n_size_bits]
+            return np.packbits(bits, axis=1, bitorder="little").tobytes()
+        v = (offsets | (sizes << np.uint64(self.n_offset_bits))).astype("<u8")
+        return v.view(np.uint8).reshape(-1, 8)[:, :self.directory_entry_size]\
+            .tobytes()
+
+    def decode_entries(self, buf):
+        """
+        Decode a run of directory entries
+
+        :param buf: a buffer holding whole directory entries, end-to-end
+        :return: a two-tuple of arrays of offsets and sizes
+        """
+        raw = np.frombuffer(buf, np.uint8)\
+            .reshape(-1, self.directory_entry_size)
+        if self.directory_entry_size > 8:
+            bits = np.unpackbits(raw, axis=1, bitorder="little")
+            fields = []
+            for start, n_bits in ((0, self.n_offset_bits),
+                                  (self.n_offset_bits, self.n_size_bits)):
+                field = np.zeros((len(raw), 64), np.uint8)
+                field[:, :n_bits] = bits[:, start:start + n_bits]
+                fields.append(np.packbits(field, axis=1, bitorder="little")
+                              .view("<u8").ravel().astype(np.uint64))
+            return tuple(fields)
+        padded = np.zeros((len(raw), 8), np.uint8)
+        padded[:, :self.directory_entry_size] = raw
+        v = padded.view("<u8").ravel()
+        offsets = v & np.uint64((1 << self.n_offset_bits) - 1)
+        sizes = (v >> np.uint64(self.n_offset_bits)) & \
+            np.uint64((1 << self.n_size_bits) - 1)
+        return offsets, sizes
 
     @staticmethod
     def open(directory_filename):
@@ -260,7 +388,7 @@ class Directory:
             header = fd.read(8)
             if header != Directory.HEADER:
                 raise IOError("%s is not a BlockFS file" % directory_filename)
-            md_size, dir_offset = np.frombuffer(fd.read(8), np.uint32)
+            md_size, dir_offset = struct.unpack("<II", fd.read(8))
             metadata = json.loads(fd.read(md_size).decode("UTF-8"))
             application_metadata = {}
             for key, value in metadata.items():
@@ -340,9 +468,24 @@ class Directory:
         self.directory_offset = len(Directory.HEADER) + 8 + len(json_md)
         with open(self.directory_filename, "wb") as fd:
             fd.write(Directory.HEADER)
-            fd.write(np.array([len(json_md), self.directory_offset],
-                              np.uint32).data)
+            fd.write(struct.pack("<II", len(json_md), self.directory_offset))
             fd.write(json_md)
+            fd.flush()
+            #
+            # Allocate the whole entry region up front so that the
+            # directory writer is not growing a sparse file as it goes.
+            # Unwritten entries read as zero: "no block".
+            #
+            n_entries = self.offsetof(self.x_extent - 1,
+                                      self.y_extent - 1,
+                                      self.z_extent - 1) + 1
+            entries_size = n_entries * self.directory_entry_size
+            try:
+                os.posix_fallocate(fd.fileno(), self.directory_offset,
+                                   entries_size)
+            except (AttributeError, OSError):
+                logger.debug("Could not preallocate %s" %
+                             self.directory_filename)
         # Touch each file
         if create_shards:
             for filename in self.block_filenames:
@@ -350,23 +493,52 @@ class Directory:
                     pass
 
     def directory_writer_process(self):
-        with open(self.directory_filename, "r+b") as fd:
+        fd = os.open(self.directory_filename, os.O_RDWR)
+        try:
             while True:
-                msg = self.upqueue.get()
-                if msg is None:
+                msgs = [self.upqueue.get()]
+                while msgs[-1] is not None and \
+                        len(msgs) < self.DIRECTORY_WRITE_BATCH_SIZE:
+                    try:
+                        msgs.append(self.upqueue.get_nowait())
+                    except queue.Empty:
+                        break
+                done = msgs[-1] is None
+                if done:
+                    msgs.pop()
+                if len(msgs) > 0:
+                    self.write_directory_entries(fd, msgs)
+                if done:
                     return
-                directory_offset, offset, size = msg
-                logger.debug(
-                    "Directory writer got msg: doffset= %d, offset=%d, size=%d"
-                    % (directory_offset, offset, size))
-                file_offset = self.directory_offset + \
-                              directory_offset * self.directory_entry_size
-                a = np.zeros(self.directory_entry_size, np.uint8)
-                self.encode_directory_entry(a, offset, size)
-                fd.seek(file_offset, os.SEEK_SET)
-                fd.write(a.data)
-                logger.debug("Wrote entry of size %d to file offset %d" %
-                             (len(a.data), file_offset))
+        finally:
+            os.close(fd)
+
+    def write_directory_entries(self, fd, msgs):
+        """
+        Write a batch of directory entries, one write per contiguous run
+
+        :param fd: the file descriptor of the directory file, opened for
+        writing
+        :param msgs: a sequence of (directory_offset, offset, size) tuples.
+        If a directory offset appears more than once, the last one wins.
+        """
+        msgs = sorted(msgs, key=lambda msg: msg[0])
+        directory_offsets, offsets, sizes = \
+            [np.array(_, np.int64) for _ in zip(*msgs)]
+        logger.debug("Directory writer got %d entries", len(msgs))
+        data = self.encode_entries(offsets, sizes)
+        breaks = np.where(np.diff(directory_offsets) != 1)[0] + 1
+        starts = [0] + breaks.tolist()
+        stops = breaks.tolist() + [len(msgs)]
+        for start, stop in zip(starts, stops):
+            file_offset = self.directory_offset + \
+                          int(directory_offsets[start]) * \
+                          self.directory_entry_size
+            os.pwrite(fd, data[start * self.directory_entry_size:
+                               stop * self.directory_entry_size],
+                      file_offset)
+            logger.debug("Wrote %d entries to file offset %d",
+                         stop - start, file_offset)
 
     @property
     def shape(self):
@@ -394,7 +566,24 @@ class Directory:
             self.start_writer_processes()
         offset = self.offsetof(x, y, z)
         idx = offset % len(self.writers)
-        self.writers[idx].write(block.astype(self.dtype), offset)
+        # The writer copies (or compresses) the block before returning, so
+        # the block only needs copying to convert it.
+        self.writers[idx].write(block.astype(self.dtype, copy=False), offset)
+
+    def write_blocks_from_array(self, a:np.ndarray):
+        """
+        Write a whole volume, block by block
+
+        :param a: an array with the shape of the volume
+        """
+        assert tuple(a.shape) == self.shape
+        for z, y, x in itertools.product(
+                range(0, self.z_extent, self.z_block_size),
+                range(0, self.y_extent, self.y_block_size),
+                range(0, self.x_extent, self.x_block_size)):
+            self.write_block(a[z:z + self.z_block_size,
+                               y:y + self.y_block_size,
+                               x:x + self.x_block_size], x, y, z)
 
     def __setitem__(self, key, value):
         assert len(key) == 3, "Must have three slice indices"
@@ -410,36 +599,88 @@ class Directory:
         x1 = key[2].stop
         self.write_block(value, x0, y0, z0)
 
-    def filesize(self, filename):
-        if filename not in self.file_sizes:
-            self.file_sizes[filename] = os.stat(filename).st_size
-        return self.file_sizes[filename]
+    def close_readers(self):
+        """Release the directory mapping and block file descriptors"""
+        if self._dir_mmap is not None:
+            self._dir_mmap.close()
+            self._dir_mmap = None
+        for fd in self._block_fds.values():
+            os.close(fd)
+        self._block_fds = {}
+
+    def directory_mmap(self):
+        """A read-only memory map of the directory file, opened on demand"""
+        if self._dir_mmap is None:
+            with open(self.directory_filename, "rb") as fd:
+                self._dir_mmap = mmap.mmap(fd.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+        return self._dir_mmap
+
+    def block_fd(self, idx):
+        """A file descriptor for reading the idx'th block file"""
+        if idx not in self._block_fds:
+            fd = os.open(self.block_filenames[idx], os.O_RDONLY)
+            # Another thread may have opened the file in the meantime
+            if self._block_fds.setdefault(idx, fd) != fd:
+                os.close(fd)
+        return self._block_fds[idx]
+
+    def scratch_block(self, shape):
+        """
+        A reusable, C-contiguous array of the given shape and our dtype
 
-    def file_handle(self, filename):
-        if filename not in self.file_handles:
-            self.file_handles[filename] = open(filename, "rb")
-        return self.file_handles[filename]
+        Each thread has its own full-block buffer, allocated on first use,
+        and the array is a view of its start.
+
+        :param shape: the shape of a block, possibly clipped at the edge
+        """
+        buffer = getattr(self._scratch, "buffer", None)
+        if buffer is None:
+            buffer = np.empty(self.x_block_size * self.y_block_size *
+                              self.z_block_size * self.dtype.itemsize,
+                              np.uint8)
+            self._scratch.buffer = buffer
+        nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        return buffer[:nbytes].view(self.dtype).reshape(shape)
 
     def read_block(self, x, y, z):
+        out = np.empty(self.get_block_size(x, y, z), self.dtype)
+        self.read_block_into(x, y, z, out)
+        return out
+
+    def read_block_into(self, x, y, z, out:np.ndarray):
+        """
+        Read a block, decompressing it directly into an array
+
+        :param x: x coordinate of the block in pixels
+        :param y: y coordinate of the block in pixels
+        :param z: z coordinate of the block in pixels
+        :param out: an array or view of the block's shape and dtype. If it
+        is not C-contiguous, the block is decompressed into this thread's
+        scratch block and copied.
+        """
         offset = self.offsetof(x, y, z)
         shape = self.get_block_size(x, y, z)
+        assert tuple(out.shape) == shape
+        assert out.dtype == self.dtype
         idx = offset % len(self.block_filenames)
         directory_offset = self.directory_offset + \
                            offset * self.directory_entry_size
-        if  self.filesize(self.directory_filename) <\
-            directory_offset + self.directory_entry_size:
-            return np.zeros(shape, self.dtype)
-        fd = self.file_handle(self.directory_filename)
-        fd.seek(directory_offset, os.SEEK_SET)
-        data = fd.read(self.directory_entry_size)
-        m = np.frombuffer(data, dtype=np.uint8)
-        offset, size = self.decode_directory_entry(m)
+        dir_mmap = self.directory_mmap()
+        if len(dir_mmap) < directory_offset + self.directory_entry_size:
+            out[:] = 0
+            return
+        offset, size = self.decode_directory_entry(
+            dir_mmap[directory_offset:
+                     directory_offset + self.directory_entry_size])
         if size == 0:
-            return np.zeros(shape, self.dtype)
-        fd = self.file_handle(self.block_filenames[idx])
-        fd.seek(offset)
-        uncompressed = fd.read(size)
-        blosc = Blosc(self.compression, self.compression_level)
-        data = blosc.decode(uncompressed)
-        return np.frombuffer(data, self.dtype).reshape(shape)
+            out[:] = 0
+            return
+        compressed = os.pread(self.block_fd(idx), size, offset)
+        if out.flags.c_contiguous:
+            self._codec.decode(compressed, out=out)
+        else:
+            scratch = self.scratch_block(shape)
+            self._codec.decode(compressed, out=scratch)
+            out[:] = scratch
 
@@ -1,4 +1,7 @@
 import argparse
+import concurrent.futures
+import errno
+import mmap
 import os
 import shutil
 import sys
@@ -22,6 +25,99 @@ def parse_args(args=sys.argv[1:]):
     return parser.parse_args(args)
 
 
+def copy_range(fd_src, fd_dest, count, block_size=2 ** 20):
+    """
+    Copy bytes from the current position of one file to that of another
+
+    The kernel does the copy with os.copy_file_range where it can. Otherwise,
+    the source is memory-mapped and written from the map, or, failing that,
+    read and written in pieces of block_size bytes.
+
+    :param fd_src: the source file, positioned at the first byte to copy
+    :param fd_dest: the destination file, positioned where the bytes go
+    :param count: the number of bytes to copy
+    :param block_size: the size of a piece when copying through a buffer
+    """
+    src = fd_src.fileno()
+    dest = fd_dest.fileno()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                n = os.copy_file_range(src, dest, count)
+                if n == 0:
+                    return
+                count -= n
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                raise
+    if count > 0:
+        count -= copy_range_mmap(src, dest, count, block_size)
+    while count > 0:
+        data = os.read(src, min(count, block_size))
+        if len(data) == 0:
+            return
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[os.write(dest, view):]
+        count -= len(data)
+
+
+def copy_range_mmap(src, dest, count, block_size):
+    """
+    Copy bytes by writing them from a read-only map of the source
+
+    This saves copying the data into a buffer before writing it.
+
+    :param src: the source file descriptor, positioned at the first byte
+    :param dest: the destination file descriptor
+    :param count: the maximum number of bytes to copy
+    :param block_size: the number of bytes to write per system call
+    :return: the number of bytes copied, which is zero if the source
+    could not be mapped
+    """
+    position = os.lseek(src, 0, os.SEEK_CUR)
+    try:
+        mm = mmap.mmap(src, 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return 0
+    with mm:
+        end = min(position + count, len(mm))
+        if hasattr(mmap, "MADV_SEQUENTIAL") and end > position:
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            offset = position
+            while offset < end:
+                offset += os.write(dest,
+                                   view[offset:min(end, offset + block_size)])
+    os.lseek(src, end, os.SEEK_SET)
+    return end - position
+
+
+def move_block_file(src_path, dest_path, move):
+    """
+    Move or copy a block file over its placeholder at the destination
+
+    A move within a filesystem is a rename. Otherwise, the file is copied
+    with copy_range so that the kernel can copy, or share, its extents.
+
+    :param src_path: the block file to be moved or copied
+    :param dest_path: the path of the placeholder it replaces
+    :param move: True to move the file, False to copy it
+    """
+    os.remove(dest_path)
+    same_device = os.stat(src_path).st_dev == \
+        os.stat(os.path.dirname(dest_path)).st_dev
+    if move and same_device:
+        os.rename(src_path, dest_path)
+        return
+    with open(src_path, "rb") as fd_src, open(dest_path, "wb") as fd_dest:
+        copy_range(fd_src, fd_dest, os.fstat(fd_src.fileno()).st_size)
+    shutil.copymode(src_path, dest_path)
+    if move:
+        os.remove(src_path)
+
+
 def main(args=sys.argv[1:], move=True):
     args = parse_args(args)
     directory = Directory.open(args.source)
@@ -48,25 +144,22 @@ def main(args=sys.argv[1:], move=True):
         metadata=directory.metadata)
     dest_directory.create()
     src_length = os.stat(directory.directory_filename).st_size
-    block_size = 2 ** 20
     with open(directory.directory_filename, "rb") as fd_src:
         with open(dest_directory_filename, "r+b") as fd_dest:
             fd_src.seek(directory.directory_offset, os.SEEK_SET)
             fd_dest.seek(dest_directory.directory_offset, os.SEEK_SET)
-            for idx in range(directory.directory_offset,
-                             src_length,
-                             block_size):
-                this_block_size = min(src_length - idx, block_size)
-                a = fd_src.read(this_block_size)
-                fd_dest.write(a)
-    for src_block_path, dest_block_path in zip(
-            directory.block_filenames,
-            dest_block_filenames):
-        os.remove(dest_block_path)
-        if move:
-            shutil.move(src_block_path, dest_block_path)
-        else:
-            shutil.copy(src_block_path, dest_block_path)
+            copy_range(fd_src, fd_dest,
+                       src_length - directory.directory_offset)
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, len(dest_block_filenames))) as executor:
+        futures = [
+            executor.submit(move_block_file, src_block_path, dest_block_path,
+                            move)
+            for src_block_path, dest_block_path in zip(
+                directory.block_filenames,
+                dest_block_filenames)]
+        for future in futures:
+            future.result()
     if move:
         os.remove(directory.directory_filename)
 
@@ -3,6 +3,7 @@ import pathlib
 import sys
 
 from blockfs import Directory
+from blockfs.mv import copy_range
 
 DESCRIPTION = """blockfs-rebase rewrites the index file after it and the
 shard files have been moved to a different directory (or after the directory
@@ -17,8 +18,9 @@ def parse_args(args=sys.argv[1:]):
     )
     parser.add_argument(
         "--block-size",
-        help="Size of a block when copying the index data",
-        default=4096 * 16,
+        help="Size of a block when copying the index data, if the kernel "
+        "cannot do the copy itself",
+        default=2 ** 20,
         type=int
     )
     return parser.parse_args(args)
@@ -38,12 +40,11 @@ def main(args=sys.argv[1:]):
     src_directory.create(create_shards=False)
     with src_path.open("rb") as src_fd:
         src_fd.seek(directory_offset)
-        with dest_path.open("ab+") as dest_fd:
-            for offset in range(src_directory.directory_offset,
-                                src_path.stat().st_size,
-                                opts.block_size):
-                data = src_fd.read(opts.block_size)
-                dest_fd.write(data)
+        with dest_path.open("r+b") as dest_fd:
+            dest_fd.seek(src_directory.directory_offset)
+            copy_range(src_fd, dest_fd,
+                       src_path.stat().st_size - directory_offset,
+                       block_size=opts.block_size)
     dest_path.replace(src_path)
 
 
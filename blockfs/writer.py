@@ -1,33 +1,78 @@
 import multiprocessing
+import multiprocessing.queues
+from multiprocessing import shared_memory
 import numpy as np
-from numcodecs import Blosc
+from numcodecs import Blosc, blosc
 import os
+import queue
 import time
 import logging
 import subprocess
+import threading
+import typing
 
 logger = logging.getLogger()
 
 EOT = "End of transmission"
+#
+# The most blocks that a writer process compresses and writes at once
+#
+WRITE_BATCH_SIZE = 16
 
-class WriterMessage:
+def writer_message(a:np.ndarray, directory_offset:int,
+                   slot:int=None, buf:memoryview=None, block:bytes=None):
+    """
+    Capture a message in a format that can be passed to the writer
 
-    def __init__(self, a:np.ndarray, directory_offset:int):
-        """
-        Instantiate by capturing a message in a format that can be passed
-        through shared memory to the writer
+    Messages are plain tuples of (directory_offset, slot, shape, dtype, a,
+    block) because one is pickled for every block written.
 
-        :param a: a numpy array to be passed
-        :param directory_offset: the directory offset where the position
-        and count should be stored.
-        """
-        logger.debug("Creating writer message")
-        self.a = a
-        self.directory_offset = directory_offset
+    :param a: a numpy array to be passed
+    :param directory_offset: the directory offset where the position
+    and count should be stored.
+    :param slot: the index of the shared memory slot that holds the
+    array. If None, the array is pickled along with the message.
+    :param buf: the buffer of the shared memory slot. The array is
+    copied into it.
+    :param block: the array, already compressed by the sender. If given,
+    "a" is ignored and the writer process writes the block as-is.
+    :return: the message
+    """
+    if block is not None:
+        return directory_offset, None, None, None, None, block
+    if slot is None:
+        return directory_offset, None, None, None, a, None
+    np.copyto(np.ndarray(a.shape, a.dtype, buffer=buf), a)
+    return directory_offset, slot, a.shape, a.dtype.str, None, None
+
+
+def message_array(msg:tuple, buffers=None):
+    """
+    Get a writer message's array
+
+    :param msg: a message made by writer_message
+    :param buffers: the buffers of the shared memory slots, indexed by
+    slot
+    """
+    directory_offset, slot, shape, dtype, a, block = msg
+    if slot is None:
+        return a
+    return np.ndarray(shape, dtype, buffer=buffers[slot])
+
+
+def write_blocks(fd:int, blocks:typing.Sequence[bytes]):
+    """
+    Write a batch of blocks end-to-end, with one system call if possible
 
-    def get(self):
-        logger.debug("Getting writer message array")
-        return self.a
+    :param fd: the file descriptor to write to
+    :param blocks: the blocks to write
+    """
+    total = sum([len(block) for block in blocks])
+    written = os.writev(fd, blocks)
+    if written < total:
+        remainder = memoryview(b"".join(blocks))[written:]
+        while len(remainder) > 0:
+            remainder = remainder[os.write(fd, remainder):]
 
 
 def block_writer_process(
@@ -35,46 +80,94 @@ def block_writer_process(
         compression:str,
         compression_level:int,
         q_in:multiprocessing.Queue,
-        q_out:multiprocessing.Queue):
+        q_out:multiprocessing.Queue,
+        slot_names:typing.Sequence[str]=(),
+        q_free:multiprocessing.Queue=None,
+        n_threads:typing.Optional[int]=None):
     """
     The process function for a writer process
 
     :param path: the path to the file that the writer writes to
     :param compression: the compression method used for Blosc
     :param compression_level: the compression level to be used
-    :param q_in: WriterMessages come down this queue. The process ends when
-                 this queue is closed and nothing remains to be read.
+    :param q_in: writer messages come down this queue. The process ends when
+                 it gets EOT. If this is a JoinableQueue, each message is
+                 marked done once its block is written.
     :param q_out: We send the offset and size down this queue to indicate that
                   the message has been passed
+    :param slot_names: the names of the shared memory slots that messages
+                       may carry their arrays in
+    :param q_free: slots are handed back on this queue once their arrays
+                   have been compressed
+    :param n_threads: the number of threads Blosc uses to compress a block.
+                      If None, numcodecs' default is left alone.
     """
     pid = os.getpid()
     logger.info("%d: Starting block writer process for %s" % (pid, path))
-    with open(path, "r+b") as fd:
-        fd.seek(0, os.SEEK_END)
-        position = fd.tell()
-        blosc = Blosc(cname=compression, clevel=compression_level)
-        while True:
+    # Blosc starts a new thread pool in a forked process, so it is safe
+    # to ask for a thread count here.
+    if n_threads is None:
+        pass
+    elif n_threads > 1:
+        blosc.use_threads = True
+        blosc.set_nthreads(min(n_threads, blosc.MAX_THREADS))
+    else:
+        blosc.use_threads = False
+    shms = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    buffers = [shm.buf for shm in shms]
+    joinable = isinstance(q_in, multiprocessing.queues.JoinableQueue)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        position = os.lseek(fd, 0, os.SEEK_END)
+        codec = Blosc(cname=compression, clevel=compression_level)
+        done = False
+        while not done:
             try:
-                msg = q_in.get()
-                logger.debug("%d: Got message from queue" % pid)
+                msgs = [q_in.get()]
+                logger.debug("%d: Got message from queue", pid)
+                while msgs[-1] != EOT and len(msgs) < WRITE_BATCH_SIZE:
+                    try:
+                        msgs.append(q_in.get_nowait())
+                    except queue.Empty:
+                        break
             except IOError:
                 logger.exception("%d: Queue failed with I/O error" % pid)
                 break
-            if msg == EOT:
+            done = msgs[-1] == EOT
+            if done:
                 logger.info("%d: Got end-of-process message" % pid)
-                break
-            logger.debug("%d: Position = %d" % (pid, position))
-            a = msg.get()
-            block = blosc.encode(a)
-            count = len(block)
-            logger.debug("%d: Writing block of length %d" % (pid, count))
-            fd.write(block)
-            q_out.put((msg.directory_offset, position, count))
-            position += len(block)
-            logger.debug("%d: Task done: %d" % (pid, position))
-    logger.info("Making sure q_out is empty: %d" % pid)
-    while not q_out.empty():
-        time.sleep(.25)
+                msgs.pop()
+                if joinable:
+                    q_in.task_done()
+            if len(msgs) == 0:
+                continue
+            logger.debug("%d: Position = %d", pid, position)
+            blocks = []
+            for msg in msgs:
+                directory_offset, slot, shape, dtype, a, block = msg
+                if block is not None:
+                    blocks.append(block)
+                    continue
+                a = message_array(msg, buffers)
+                blocks.append(codec.encode(a))
+                a = None
+                if slot is not None:
+                    q_free.put(slot)
+            logger.debug("%d: Writing %d blocks", pid, len(blocks))
+            write_blocks(fd, blocks)
+            for msg, block in zip(msgs, blocks):
+                q_out.put((msg[0], position, len(block)))
+                position += len(block)
+                if joinable:
+                    q_in.task_done()
+            logger.debug("%d: Task done: %d", pid, position)
+    finally:
+        os.close(fd)
+    del buffers
+    for shm in shms:
+        shm.close()
     logger.info("Exiting process. PID=%d" % os.getpid())
 
 class BlockWriter:
@@ -82,7 +175,10 @@ class BlockWriter:
     def __init__(self, path:str, q_out:multiprocessing.Queue,
                  q_in:multiprocessing.Queue,
                  compression:str, compression_level:int,
-                 queue_depth:int = 10):
+                 queue_depth:int = 10,
+                 block_nbytes:int = None,
+                 n_threads:typing.Optional[int] = None,
+                 encode_in_producer:bool = False):
         """
         Initialize the block writer with the blockfs file's path and
         the queue which will get the write messages.
@@ -94,13 +190,40 @@ class BlockWriter:
         :param queue_depth: This limits the number of chunks that can be
         enqueued before the queue blocks. A large queue depth will eat up
         lots of memory.
+        :param block_nbytes: the size in bytes of the largest block to be
+        written. If given, blocks are passed to the writer process through
+        queue_depth preallocated shared memory slots of this size rather
+        than being pickled.
+        :param n_threads: the number of threads the writer process uses to
+        compress each block. If None, numcodecs' default is used.
+        :param encode_in_producer: if True, blocks are compressed by the
+        process that calls write() and only the compressed bytes are sent
+        to the writer process. This spreads compression across producing
+        processes and sends less data, at the cost of compressing in the
+        caller. No shared memory slots are allocated in this case.
         """
         logger.info("Initializing block writer for path %s" % path)
         self.q_in = q_in
         self.q_out = q_out
+        self.block_nbytes = block_nbytes
+        if encode_in_producer:
+            self.codec = Blosc(cname=compression, clevel=compression_level)
+        else:
+            self.codec = None
+        if block_nbytes is None or encode_in_producer:
+            self.shms = []
+            self.q_free = None
+        else:
+            self.shms = [
+                shared_memory.SharedMemory(create=True, size=block_nbytes)
+                for _ in range(queue_depth)]
+            self.q_free = multiprocessing.Queue()
+            for slot in range(queue_depth):
+                self.q_free.put(slot)
         self.process = multiprocessing.Process(
             target = block_writer_process,
-            args=(path, compression, compression_level, self.q_in, self.q_out)
+            args=(path, compression, compression_level, self.q_in, self.q_out,
+                  [shm.name for shm in self.shms], self.q_free, n_threads)
         )
         self.started = False
         self.stopped = False
@@ -114,15 +237,36 @@ class BlockWriter:
         self.started = True
 
     def stop(self):
-        """Stop the writer process by sending it a message"""
+        """
+        Stop the writer process by sending it a message
+
+        The message is sent once the writer has written every block already
+        sent to it. Block positions that the writer has yet to send down
+        q_out are flushed when the writer process exits. Raises IOError if
+        the writer process dies before writing every block.
+        """
         if self.stopped:
             return
-        while not self.q_in.empty():
-            logger.info("Waiting for input queue to empty: %d" % self.pid)
-            time.sleep(.25)
-        while not self.q_out.empty():
-            logger.info("Waiting for output queue to empty: %d" % self.pid)
-            time.sleep(.25)
+        if isinstance(self.q_in, multiprocessing.queues.JoinableQueue):
+            logger.info("Waiting for input queue to be done: %d" % self.pid)
+            #
+            # A writer that dies never marks its message done, so wait on
+            # a helper thread and keep checking that the writer is alive.
+            #
+            joiner = threading.Thread(target=self.q_in.join, daemon=True)
+            joiner.start()
+            while joiner.is_alive():
+                joiner.join(.25)
+                if joiner.is_alive() and not self.process.is_alive():
+                    self.stopped = True
+                    raise IOError(
+                        "Block writer %d exited with code %s before writing "
+                        "all of its blocks" %
+                        (self.pid, self.process.exitcode))
+        else:
+            while not self.q_in.empty():
+                logger.info("Waiting for input queue to empty: %d" % self.pid)
+                time.sleep(.25)
         logger.info("Stopping block writer: %d" % self.pid)
         self.q_in.put(EOT)
         self.stopped = True
@@ -135,12 +279,17 @@ class BlockWriter:
         """
         if self.closed:
             return
-        self.stop()
-        logger.info("Closing block writer: %d" % self.pid)
-        if self.started:
-            self.process.join()
-        logger.info("Block writer closed: %d" % self.pid)
-        self.closed = True
+        try:
+            self.stop()
+        finally:
+            logger.info("Closing block writer: %d" % self.pid)
+            if self.started:
+                self.process.join()
+            for shm in self.shms:
+                shm.close()
+                shm.unlink()
+            logger.info("Block writer closed: %d" % self.pid)
+            self.closed = True
 
     def write(self, a:np.ndarray, directory_offset:int):
         """
@@ -150,7 +299,42 @@ class BlockWriter:
         :param directory_offset: this directory offset will be sent to the
         output queue once the block has been written
         """
-        logger.debug("Sending block to queue. Directory offset = %d" %
+        logger.debug("Sending block to queue. Directory offset = %d",
                      directory_offset)
-        msg = WriterMessage(a, directory_offset)
-        self.q_in.put(msg)
\ No newline at end of file
+        if self.codec is not None:
+            # Blosc can only encode contiguous memory
+            msg = writer_message(None, directory_offset,
+                                 block=self.codec.encode(
+                                     np.ascontiguousarray(a)))
+        elif len(self.shms) > 0 and a.nbytes <= self.block_nbytes:
+            slot = self.q_free.get()
+            msg = writer_message(a, directory_offset, slot,
+                                 self.shms[slot].buf)
+        else:
+            # The queue pickles the message later, on its feeder thread,
+            # so take a copy that the caller cannot change in the meantime.
+            msg = writer_message(np.array(a), directory_offset)
+        self.q_in.put(msg)
+
+    def flush_completions(self, n:int):
+        """
+        Collect the results of up to n writes from the output queue
+
+        This waits for the first result and then takes whatever others
+        have already arrived, so a caller that has written many blocks
+        can collect their results in a few batches. It is only useful
+        when the output queue belongs to this writer: a Directory's
+        directory writer thread drains it otherwise.
+
+        :param n: the maximum number of results to collect
+        :return: a list of (directory_offset, position, size) tuples
+        """
+        if n <= 0:
+            return []
+        results = [self.q_out.get()]
+        while len(results) < n:
+            try:
+                results.append(self.q_out.get_nowait())
+            except queue.Empty:
+                break
+        return results
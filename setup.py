@@ -33,8 +33,11 @@ setup(
     license="MIT",
     classifiers=[
         "Development Status :: 5 - Production/Stable",
-        'Programming Language :: Python :: 3.5'
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9"
     ],
+    python_requires=">=3.8",
     entry_points=dict(
         console_scripts = console_scripts
     ),
@@ -42,7 +45,7 @@ setup(
         "mp_shared_memory",
         "numpy",
         "numcodecs",
-        "tifffile",
+        "tifffile>=2022.7.28",
         "tqdm"
     ],
     extras_require={
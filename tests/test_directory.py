@@ -1,8 +1,10 @@
 import unittest
 from blockfs import Directory, Compression
+from blockfs.directory import set_blosc_threads
 from blockfs.test_utils import make_files
 import numpy as np
-from numcodecs import Blosc
+import os
+from numcodecs import Blosc, blosc
 
 class TestDirectory(unittest.TestCase):
     def test_01_create(self):
@@ -15,6 +17,21 @@ class TestDirectory(unittest.TestCase):
                 header = fd.read(len(Directory.HEADER))
                 self.assertEqual(header, Directory.HEADER)
 
+    def test_01_01_create_preallocates(self):
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(1000, 1024, 1024, np.uint16, dir_file,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.close()
+            n_entries = 16 * 16 * 16
+            self.assertEqual(
+                os.path.getsize(dir_file),
+                directory.directory_offset +
+                n_entries * directory.directory_entry_size)
+            directory = Directory.open(dir_file)
+            np.testing.assert_array_equal(
+                directory.read_block(64, 128, 192), 0)
+
     def test_02_create_and_open(self):
         with make_files(1) as (dir_file, block_files):
             directory = Directory(1024, 1024, 1024, np.uint16, dir_file,
@@ -27,6 +44,18 @@ class TestDirectory(unittest.TestCase):
             self.assertEqual(directory.y_extent, 1024)
             self.assertEqual(directory.z_extent, 1024)
 
+    def test_02_00_offsets_grid(self):
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(1000, 1024, 1024, np.uint16, dir_file,
+                                  block_filenames=block_files)
+            xs = range(0, 1000, 64)
+            ys = range(0, 1024, 64)
+            zs = range(0, 1024, 64)
+            offsets = directory.offsets_grid(xs, ys, zs)
+            expected = [directory.offsetof(x, y, z)
+                        for z in zs for y in ys for x in xs]
+            np.testing.assert_array_equal(offsets, expected)
+
     def test_02_01_encode_decode(self):
         with make_files(1) as (dir_file, block_files):
             directory = Directory(1024, 1024, 1024, np.uint16, dir_file,
@@ -43,6 +72,68 @@ class TestDirectory(unittest.TestCase):
             finally:
                 directory.close()
 
+    def test_02_02_encode_decode_entries(self):
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(1024, 1024, 1024, np.uint16, dir_file,
+                                  block_filenames=block_files)
+            offsets = np.array([0, 524304, 1 << 30, 12345])
+            sizes = np.array([524304, 524304, 16, 0])
+            data = directory.encode_entries(offsets, sizes)
+            self.assertEqual(len(data),
+                             len(offsets) * directory.directory_entry_size)
+            offsets_out, sizes_out = directory.decode_entries(data)
+            np.testing.assert_array_equal(offsets, offsets_out)
+            np.testing.assert_array_equal(sizes, sizes_out)
+            for idx, (offset, size) in enumerate(zip(offsets, sizes)):
+                entry = np.frombuffer(data, np.uint8)[
+                    idx * directory.directory_entry_size:
+                    (idx + 1) * directory.directory_entry_size]
+                self.assertEqual(directory.decode_directory_entry(entry),
+                                 (offset, size))
+
+    def test_02_02_01_encode_decode_wide_entries(self):
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(1024, 1024, 1024, np.uint16, dir_file,
+                                  n_offset_bits=48, n_size_bits=33,
+                                  block_filenames=block_files)
+            self.assertEqual(directory.directory_entry_size, 11)
+            offsets = np.array([0, (1 << 48) - 1, 1 << 40, 12345])
+            sizes = np.array([(1 << 33) - 1, 524304, 16, 0])
+            data = directory.encode_entries(offsets, sizes)
+            self.assertEqual(len(data), 4 * 11)
+            offsets_out, sizes_out = directory.decode_entries(data)
+            np.testing.assert_array_equal(offsets, offsets_out)
+            np.testing.assert_array_equal(sizes, sizes_out)
+            for idx, (offset, size) in enumerate(zip(offsets, sizes)):
+                expected = int(offset) + (int(size) << 48)
+                self.assertEqual(
+                    data[idx * 11:(idx + 1) * 11],
+                    expected.to_bytes(11, "little"))
+                a = np.zeros(11, np.uint8)
+                directory.encode_directory_entry(a, int(offset), int(size))
+                self.assertEqual(directory.decode_directory_entry(a),
+                                 (offset, size))
+
+    def test_02_03_write_directory_entries(self):
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(1024, 1024, 1024, np.uint16, dir_file,
+                                  block_filenames=block_files)
+            directory.create()
+            msgs = [(3, 300, 30), (0, 0, 10), (1, 100, 11), (7, 700, 70),
+                    (2, 200, 20), (1, 100, 12)]
+            fd = os.open(dir_file, os.O_RDWR)
+            try:
+                directory.write_directory_entries(fd, msgs)
+            finally:
+                os.close(fd)
+            with open(dir_file, "rb") as fd:
+                fd.seek(directory.directory_offset)
+                data = fd.read(8 * directory.directory_entry_size)
+            offsets, sizes = directory.decode_entries(data)
+            np.testing.assert_array_equal(
+                offsets, [0, 100, 200, 300, 0, 0, 0, 700])
+            np.testing.assert_array_equal(sizes, [10, 12, 20, 30, 0, 0, 0, 70])
+
     def test_03_write(self):
         a = np.random.randint(0, 65535, (64, 64, 64), np.uint16)
         with make_files(1) as (dir_file, block_files):
@@ -89,6 +180,64 @@ class TestDirectory(unittest.TestCase):
             b_out = directory.read_block(0, 0, 0)
             np.testing.assert_array_equal(b, b_out)
 
+    def test_04_02_write_read_blosc_threads(self):
+        a = np.random.randint(0, 65535, (64, 64, 64), np.uint16)
+        n_threads = blosc.get_nthreads()
+        set_blosc_threads()
+        try:
+            with make_files(1) as (dir_file, block_files):
+                directory = Directory(1024, 1024, 1024, np.uint16, dir_file,
+                                      compression=Compression.zstd,
+                                      block_filenames=block_files)
+                directory.create()
+                directory.write_block(a, 64, 128, 192)
+                directory.close()
+                a_out = Directory.open(dir_file).read_block(64, 128, 192)
+                np.testing.assert_array_equal(a, a_out)
+        finally:
+            blosc.set_nthreads(n_threads)
+
+    def test_04_03_read_block_into(self):
+        a = np.random.randint(0, 65535, (64, 64, 64), np.uint16)
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(1024, 1024, 1024, np.uint16, dir_file,
+                                  compression=Compression.zstd,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.write_block(a, 64, 128, 192)
+            directory.close()
+            directory = Directory.open(dir_file)
+            out = np.zeros((64, 64, 64), np.uint16)
+            directory.read_block_into(64, 128, 192, out)
+            np.testing.assert_array_equal(a, out)
+            big = np.ones((64, 128, 128), np.uint16)
+            directory.read_block_into(64, 128, 192, big[:, 32:96, 64:])
+            np.testing.assert_array_equal(a, big[:, 32:96, 64:])
+            self.assertTrue(np.all(big[:, :32] == 1))
+            directory.read_block_into(0, 0, 0, big[:, 32:96, 64:])
+            np.testing.assert_array_equal(big[:, 32:96, 64:], 0)
+
+    def test_04_04_read_block_into_strided_reuses_scratch(self):
+        a = np.random.randint(0, 65535, (64, 64, 40), np.uint16)
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(1000, 1024, 1024, np.uint16, dir_file,
+                                  compression=Compression.zstd,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.write_block(a, 960, 128, 192)
+            directory.close()
+            directory = Directory.open(dir_file)
+            scratch = directory.scratch_block((64, 64, 64))
+            big = np.zeros((64, 128, 128), np.uint16)
+            directory.read_block_into(960, 128, 192, big[:, 32:96, 64:104])
+            np.testing.assert_array_equal(a, big[:, 32:96, 64:104])
+            #
+            # The block was decoded into the scratch buffer, not a new one
+            #
+            edge = directory.scratch_block(a.shape)
+            self.assertTrue(np.shares_memory(scratch, edge))
+            np.testing.assert_array_equal(a, edge)
+
     def test_05_write_not_there(self):
         a = np.random.randint(0, 65535, (64, 64, 64), np.uint16)
         with make_files(1) as (dir_file, block_files):
@@ -113,6 +262,72 @@ class TestDirectory(unittest.TestCase):
             a_out = directory.read_block(64, 128, 192)
             np.testing.assert_array_equal(a_out, 0)
 
+    def test_05_01_write_blocks_from_array(self):
+        a = np.random.randint(0, 65535, (100, 130, 70), np.uint16)
+        with make_files(2) as (dir_file, block_files):
+            directory = Directory(70, 130, 100, np.uint16, dir_file,
+                                  compression=Compression.zstd,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.write_blocks_from_array(a)
+            directory.close()
+            directory = Directory.open(dir_file)
+            for z in range(0, 100, 64):
+                for y in range(0, 130, 64):
+                    for x in range(0, 70, 64):
+                        np.testing.assert_array_equal(
+                            a[z:z+64, y:y+64, x:x+64],
+                            directory.read_block(x, y, z))
+
+    def test_05_02_write_blocks_from_array_encode_in_producer(self):
+        a = np.random.randint(0, 65535, (100, 130, 70), np.uint16)
+        with make_files(2) as (dir_file, block_files):
+            directory = Directory(70, 130, 100, np.uint16, dir_file,
+                                  compression=Compression.zstd,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.start_writer_processes(encode_in_producer=True)
+            directory.write_blocks_from_array(a)
+            directory.close()
+            directory = Directory.open(dir_file)
+            for z in range(0, 100, 64):
+                for y in range(0, 130, 64):
+                    for x in range(0, 70, 64):
+                        np.testing.assert_array_equal(
+                            a[z:z+64, y:y+64, x:x+64],
+                            directory.read_block(x, y, z))
+
+    def test_05_03_write_blocks_from_array_shared_memory(self):
+        a = np.random.randint(0, 65535, (100, 130, 70), np.uint16)
+        with make_files(2) as (dir_file, block_files):
+            directory = Directory(70, 130, 100, np.uint16, dir_file,
+                                  compression=Compression.zstd,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.start_writer_processes(use_shared_memory=True)
+            self.assertTrue(all([len(writer.shms) == 10
+                                 for writer in directory.writers]))
+            directory.write_blocks_from_array(a)
+            directory.close()
+            directory = Directory.open(dir_file)
+            for z in range(0, 100, 64):
+                for y in range(0, 130, 64):
+                    for x in range(0, 70, 64):
+                        np.testing.assert_array_equal(
+                            a[z:z+64, y:y+64, x:x+64],
+                            directory.read_block(x, y, z))
+
+    def test_05_04_no_shared_memory_by_default(self):
+        with make_files(2) as (dir_file, block_files):
+            directory = Directory(70, 130, 100, np.uint16, dir_file,
+                                  compression=Compression.zstd,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.start_writer_processes()
+            self.assertTrue(all([len(writer.shms) == 0
+                                 for writer in directory.writers]))
+            directory.close()
+
     def test_06_write_using_array_interface(self):
         a = np.random.randint(0, 65535, (64, 64, 64), np.uint16)
         with make_files(1) as (dir_file, block_files):
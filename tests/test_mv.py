@@ -1,3 +1,6 @@
+import concurrent.futures
+import contextlib
+import errno
 import itertools
 import numpy as np
 import os
@@ -5,74 +8,123 @@ import shutil
 import subprocess
 import unittest
 import tempfile
+import unittest.mock
 
 from blockfs import Directory, Compression
 from blockfs.test_utils import make_files
-from blockfs.mv import main, copy_main
+from blockfs.mv import main, copy_main, copy_range, copy_range_mmap
+
+#
+# The (x, y, z) corners of the blocks of the 256^3 test volume
+#
+COORDS = tuple(itertools.product(range(0, 256, 64), repeat=3))
 
 class TestMv(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.a = np.random.default_rng(1234).integers(
+            0, 65535, (256, 256, 256), dtype=np.uint16)
+
+    def check_directory(self, directory_file):
+        directory = Directory.open(directory_file)
+        out = np.zeros_like(self.a)
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            list(executor.map(
+                lambda xyz: directory.read_block_into(
+                    *xyz, out[xyz[2]:xyz[2]+64,
+                              xyz[1]:xyz[1]+64,
+                              xyz[0]:xyz[0]+64]),
+                COORDS))
+        np.testing.assert_array_equal(self.a, out)
+
+    @contextlib.contextmanager
+    def make_source(self):
+        with make_files(1) as (dir_file, block_files):
+            directory = Directory(256, 256, 256, np.uint16, dir_file,
+                                  compression=Compression.zstd,
+                                  block_filenames=block_files)
+            directory.create()
+            directory.write_blocks_from_array(self.a)
+            directory.close()
+            yield dir_file
+
+    def run_mv(self, mv):
+        with self.make_source() as dir_file:
+            dest = tempfile.mkdtemp()
+            try:
+                mv(dir_file, dest)
+                self.check_directory(
+                    os.path.join(dest, os.path.split(dir_file)[1]))
+            finally:
+                shutil.rmtree(dest)
+
     def test_mv(self):
-        for i in range(2):
-            a = np.random.randint(0, 65535, (256, 256, 256), np.uint16)
-            with make_files(1) as (dir_file, block_files):
-                directory = Directory(256, 256, 256, np.uint16, dir_file,
-                                      compression=Compression.zstd,
-                                      block_filenames=block_files)
-                directory.create()
-                for x, y, z in itertools.product(range(0, 256, 64),
-                                                 range(0, 256, 64),
-                                                 range(0, 256, 64)):
-                    directory.write_block(a[z:z+64, y:y+64, x:x+64], x, y, z)
-                directory.close()
-                dest = tempfile.mkdtemp()
-                try:
-                    if i == 0:
-                        main([dir_file, dest])
-                    else:
-                        subprocess.check_call(["blockfs-mv", dir_file, dest])
-                    dest_dir_file = \
-                        os.path.join(dest, os.path.split(dir_file)[1])
-                    dest_directory = Directory.open(dest_dir_file)
-                    for x, y, z in itertools.product(range(0, 256, 64),
-                                                     range(0, 256, 64),
-                                                     range(0, 256, 64)):
-                        block = dest_directory.read_block( x, y, z)
-                        np.testing.assert_array_equal(
-                            a[z:z+64, y:y+64, x:x+64], block)
-                finally:
-                    shutil.rmtree(dest)
+        self.run_mv(lambda src, dest: main([src, dest]))
+
+    def test_mv_subprocess(self):
+        self.run_mv(lambda src, dest:
+                    subprocess.check_call(["blockfs-mv", src, dest]))
 
     def test_cp(self):
-        for i in range(2):
-            a = np.random.randint(0, 65535, (256, 256, 256), np.uint16)
-            with make_files(1) as (dir_file, block_files):
-                directory = Directory(256, 256, 256, np.uint16, dir_file,
-                                      compression=Compression.zstd,
-                                      block_filenames=block_files)
-                directory.create()
-                for x, y, z in itertools.product(range(0, 256, 64),
-                                                 range(0, 256, 64),
-                                                 range(0, 256, 64)):
-                    directory.write_block(a[z:z+64, y:y+64, x:x+64], x, y, z)
-                directory.close()
+        #
+        # The source survives the copy, so one source serves both the
+        # in-process and the command-line copies.
+        #
+        with self.make_source() as dir_file:
+            for i in range(2):
                 dest = tempfile.mkdtemp()
                 try:
                     if i == 0:
                         copy_main([dir_file, dest])
                     else:
                         subprocess.check_call(["blockfs-cp", dir_file, dest])
-                    dest_dir_file = \
-                        os.path.join(dest, os.path.split(dir_file)[1])
-                    for directory_file in dir_file, dest_dir_file:
-                        dest_directory = Directory.open(directory_file)
-                        for x, y, z in itertools.product(range(0, 256, 64),
-                                                         range(0, 256, 64),
-                                                         range(0, 256, 64)):
-                            block = dest_directory.read_block( x, y, z)
-                            np.testing.assert_array_equal(
-                                a[z:z+64, y:y+64, x:x+64], block)
+                    self.check_directory(
+                        os.path.join(dest, os.path.split(dir_file)[1]))
                 finally:
                     shutil.rmtree(dest)
+            self.check_directory(dir_file)
+
+    def test_copy_range(self):
+        data = np.random.randint(0, 255, 100000, np.uint8).tobytes()
+        with tempfile.TemporaryFile() as fd_src, \
+                tempfile.TemporaryFile() as fd_dest:
+            fd_src.write(data)
+            fd_src.flush()
+            fd_dest.write(b"header")
+            fd_dest.flush()
+            fd_src.seek(1000)
+            copy_range(fd_src, fd_dest, 50000)
+            fd_dest.seek(0)
+            self.assertEqual(fd_dest.read(), b"header" + data[1000:51000])
+
+    def test_copy_range_without_copy_file_range(self):
+        data = np.random.randint(0, 255, 100000, np.uint8).tobytes()
+        with tempfile.TemporaryFile() as fd_src, \
+                tempfile.TemporaryFile() as fd_dest:
+            fd_src.write(data)
+            fd_src.flush()
+            error = OSError(errno.EXDEV, "Cross-device link")
+            with unittest.mock.patch("os.copy_file_range", create=True,
+                                     side_effect=error):
+                fd_src.seek(1000)
+                copy_range(fd_src, fd_dest, 50000, block_size=777)
+            fd_dest.seek(0)
+            self.assertEqual(fd_dest.read(), data[1000:51000])
+            self.assertEqual(fd_src.tell(), 51000)
+
+    def test_copy_range_mmap_past_end(self):
+        data = np.random.randint(0, 255, 1000, np.uint8).tobytes()
+        with tempfile.TemporaryFile() as fd_src, \
+                tempfile.TemporaryFile() as fd_dest:
+            fd_src.write(data)
+            fd_src.flush()
+            fd_src.seek(900)
+            self.assertEqual(
+                copy_range_mmap(fd_src.fileno(), fd_dest.fileno(), 500, 64),
+                100)
+            fd_dest.seek(0)
+            self.assertEqual(fd_dest.read(), data[900:])
+
 
 if __name__ == '__main__':
     unittest.main()
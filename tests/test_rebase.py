@@ -1,3 +1,4 @@
+import concurrent.futures
 import itertools
 import tempfile
 import traceback
@@ -10,15 +11,24 @@ from blockfs import Directory, Compression
 from blockfs.rebase import main
 
 
+#
+# The (x, y, z) corners of the blocks of the 256^3 test volume
+#
+COORDS = tuple(itertools.product(range(0, 256, 64), repeat=3))
+
 class TestRebase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.a = np.random.default_rng(1234).integers(
+            0, 65535, (256, 256, 256), dtype=np.uint16)
+
     def test_case(self):
         src_dir = pathlib.Path(tempfile.mkdtemp())
         dest_dir_parent = pathlib.Path(tempfile.mkdtemp())
         dest_dir = dest_dir_parent / "dest"
         dest_dir.mkdir()
         all_files = []
-        rs = np.random.RandomState(1234)
-        a = rs.randint(0, 65535, (256, 256, 256), dtype=np.uint16)
+        a = self.a
         try:
             dir_file = src_dir / "my.blockfs"
             block_files = [src_dir / ("my.blockfs.%d" % i) for i in range(4)]
@@ -27,11 +37,7 @@ class TestRebase(unittest.TestCase):
                                   block_filenames=
                                   [str(_) for _ in block_files])
             directory.create()
-            for x, y, z in itertools.product(range(0, 256, 64),
-                                             range(0, 256, 64),
-                                             range(0, 256, 64)):
-                directory.write_block(
-                    a[z:z + 64, y:y + 64, x:x + 64], x, y, z)
+            directory.write_blocks_from_array(a)
             directory.close()
             for path in [dir_file] + list(block_files):
                 dest_path = dest_dir / path.name
@@ -40,11 +46,15 @@ class TestRebase(unittest.TestCase):
             dest_directory_file = dest_dir / pathlib.Path(dir_file).name
             main([str(dest_directory_file)])
             directory = Directory.open(str(dest_directory_file))
-            for x, y, z in itertools.product(range(0, 256, 64),
-                                             range(0, 256, 64),
-                                             range(0, 256, 64)):
-                np.testing.assert_array_equal(a[z:z+64, y:y+64, x:x+64],
-                                              directory.read_block(x, y, z))
+            out = np.zeros_like(a)
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                list(executor.map(
+                    lambda xyz: directory.read_block_into(
+                        *xyz, out[xyz[2]:xyz[2]+64,
+                                  xyz[1]:xyz[1]+64,
+                                  xyz[0]:xyz[0]+64]),
+                    COORDS))
+            np.testing.assert_array_equal(a, out)
         finally:
             try:
                 for path in all_files:
@@ -1,3 +1,5 @@
+import mmap
+import os
 import unittest
 import numpy as np
 import multiprocessing
@@ -8,9 +10,24 @@ from numcodecs import Blosc
 class TestWriter(unittest.TestCase):
     def test_01_writer_message(self):
         a = np.random.randint(0, np.iinfo(np.uint16).max, (4, 5, 6))
-        msg = w.WriterMessage(a, 1234)
-        self.assertEqual(msg.directory_offset, 1234)
-        np.testing.assert_array_equal(msg.get(), a)
+        msg = w.writer_message(a, 1234)
+        self.assertEqual(msg[0], 1234)
+        np.testing.assert_array_equal(w.message_array(msg), a)
+
+    def test_01_01_writer_message_slot(self):
+        a = np.random.randint(0, np.iinfo(np.uint16).max, (4, 5, 6))
+        buffers = [bytearray(a.nbytes), bytearray(a.nbytes)]
+        msg = w.writer_message(a, 1234, 1, memoryview(buffers[1]))
+        self.assertEqual(msg[0], 1234)
+        self.assertIsNone(msg[4])
+        np.testing.assert_array_equal(w.message_array(msg, buffers), a)
+
+    def test_01_02_write_blocks(self):
+        blocks = [b"foo", b"", np.arange(1000, dtype=np.uint16).tobytes()]
+        with tempfile.NamedTemporaryFile() as tf:
+            w.write_blocks(tf.file.fileno(), blocks)
+            tf.file.seek(0)
+            self.assertEqual(tf.file.read(), b"".join(blocks))
 
     def test_02_writer_open_close(self):
         with tempfile.NamedTemporaryFile() as tf:
@@ -28,16 +45,114 @@ class TestWriter(unittest.TestCase):
             writer = w.BlockWriter(tf.name, q_out, q_in, "zstd", 5)
             writer.start()
             writer.write(a, 1234)
-            directory_offset, position, size = q_out.get()
+            (directory_offset, position, size), = writer.flush_completions(1)
             writer.close()
             self.assertEqual(directory_offset, 1234)
             self.assertEqual(position, 0)
+            self.assertEqual(os.fstat(tf.file.fileno()).st_size, size)
+            a_out = np.zeros_like(a)
+            with mmap.mmap(tf.file.fileno(), size,
+                           access=mmap.ACCESS_READ) as mm:
+                Blosc("zstd", 5).decode(mm, out=a_out)
+            np.testing.assert_array_equal(a, a_out)
+
+    def test_04_writer_send_shared_memory(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            q_in = multiprocessing.Queue()
+            q_out = multiprocessing.Queue()
+            arrays = [np.random.randint(0, np.iinfo(np.uint16).max,
+                                        (4, 5, 6), np.uint16)
+                      for _ in range(5)]
+            writer = w.BlockWriter(tf.name, q_out, q_in, "zstd", 5,
+                                   queue_depth=2,
+                                   block_nbytes=arrays[0].nbytes,
+                                   n_threads=2)
+            writer.start()
+            for i, a in enumerate(arrays):
+                writer.write(a, i)
+            results = [q_out.get() for _ in arrays]
+            writer.close()
+            data = tf.file.read()
+            for i, a in enumerate(arrays):
+                directory_offset, position, size = results[i]
+                self.assertEqual(directory_offset, i)
+                a_out = np.frombuffer(
+                    Blosc("zstd", 5).decode(data[position:position + size]),
+                    a.dtype).reshape(a.shape)
+                np.testing.assert_array_equal(a, a_out)
+
+    def test_05_writer_send_encoded(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            q_in = multiprocessing.Queue()
+            q_out = multiprocessing.Queue()
+            a = np.random.randint(0, np.iinfo(np.uint16).max, (4, 5, 6))
+            writer = w.BlockWriter(tf.name, q_out, q_in, "zstd", 5,
+                                   block_nbytes=a.nbytes,
+                                   encode_in_producer=True)
+            writer.start()
+            writer.write(a, 1234)
+            directory_offset, position, size = q_out.get()
+            writer.close()
+            self.assertEqual(directory_offset, 1234)
             block = tf.file.read()
             self.assertEqual(len(block), size)
-            a_out = np.frombuffer(Blosc("zstr", 5).decode(block),
+            a_out = np.frombuffer(Blosc("zstd", 5).decode(block),
                                   a.dtype).reshape(a.shape)
             np.testing.assert_array_equal(a, a_out)
 
+    def test_06_writer_joinable_queue(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            q_in = multiprocessing.JoinableQueue()
+            q_out = multiprocessing.Queue()
+            arrays = [np.random.randint(0, np.iinfo(np.uint16).max,
+                                        (4, 5, 6), np.uint16)
+                      for _ in range(20)]
+            writer = w.BlockWriter(tf.name, q_out, q_in, "zstd", 5)
+            writer.start()
+            for i, a in enumerate(arrays):
+                writer.write(a, i)
+            writer.close()
+            results = sorted([q_out.get() for _ in arrays])
+            data = tf.file.read()
+            self.assertEqual(len(data), sum([_[2] for _ in results]))
+            for a, (directory_offset, position, size) in zip(arrays, results):
+                a_out = np.frombuffer(
+                    Blosc("zstd", 5).decode(data[position:position + size]),
+                    a.dtype).reshape(a.shape)
+                np.testing.assert_array_equal(a, a_out)
+
+    def test_07_writer_flush_completions(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            q_in = multiprocessing.JoinableQueue()
+            q_out = multiprocessing.Queue()
+            arrays = [np.random.randint(0, np.iinfo(np.uint16).max,
+                                        (4, 5, 6), np.uint16)
+                      for _ in range(16)]
+            writer = w.BlockWriter(tf.name, q_out, q_in, "zstd", 5,
+                                   block_nbytes=arrays[0].nbytes)
+            writer.start()
+            for i, a in enumerate(arrays):
+                writer.write(a, i)
+            results = []
+            while len(results) < len(arrays):
+                batch = writer.flush_completions(len(arrays) - len(results))
+                self.assertGreater(len(batch), 0)
+                results += batch
+            writer.close()
+            self.assertEqual(sorted([_[0] for _ in results]),
+                             list(range(len(arrays))))
+            self.assertEqual(writer.flush_completions(0), [])
+
+    def test_08_writer_crash(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            q_in = multiprocessing.JoinableQueue()
+            q_out = multiprocessing.Queue()
+            writer = w.BlockWriter(tf.name, q_out, q_in, "zstd", 5)
+            writer.start()
+            # Blosc cannot encode an object array: the writer dies
+            writer.write(np.array([object()]), 1234)
+            self.assertRaises(IOError, writer.close)
+            self.assertFalse(writer.process.is_alive())
 
 
 if __name__ == '__main__':